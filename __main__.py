@@ -1,5 +1,9 @@
 #!/usr/bin/python3
+import multiprocessing
+import os
 import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
 
@@ -517,17 +521,22 @@ def eval_statement(statement, variables, function_table):
     if type_is(statement, TokenType.ASSIGNMENT):
         eval_assignment(statement[1], statement[2], variables, function_table)
     elif type_is(statement, TokenType.OUTPUT):
-        print(eval_expression(statement[1], variables, function_table))
+        eval_output(statement[1], variables, function_table)
     elif type_is(statement, TokenType.INPUT):
         variables[statement[1][1]] = input()
     elif type_is(statement, TokenType.IF):
         res = eval_expression(statement[1], variables, function_table)
         if res:
-            eval_statements(statement[2], variables)
+            eval_statements(statement[2], variables, function_table)
     elif type_is(statement, TokenType.LOOP):
+        if parallel_workers > 1 and parallel_queue is None:
+            analysis = loop_analysis(statement, function_table)
+            if analysis is not None:
+                eval_parallel_loop(statement, analysis, variables, function_table)
+                return
         _, comp, expr, rest = statement
         while eval_expression(expr, variables, function_table) == comp:
-            eval_statements(rest, variables)
+            eval_statements(rest, variables, function_table)
 
     elif type_is(statement, TokenType.TURN):
         _, kind, var = statement
@@ -562,8 +571,19 @@ def eval_function_call(call, variables, function_table):
     if call[1] not in function_table:
         raise ValueError("Cannot find function of name {}".format(call[1]))
     func = function_table[call[1]]
-    local_vars = {k[1]: eval_expression(v, variables, function_table)
-                   for (k, v) in zip(func[2], call[2])}
+    arguments = eval_arguments(func, call, variables, function_table)
+    return call_function(func, arguments, function_table)
+
+
+def eval_arguments(func, call, variables, function_table):
+    """ Evaluates the arguments of a call, in order. """
+    return [eval_expression(v, variables, function_table)
+            for (_, v) in zip(func[2], call[2])]
+
+
+def call_function(func, arguments, function_table):
+    """ Runs the body of a function with already evaluated arguments. """
+    local_vars = {k[1]: v for (k, v) in zip(func[2], arguments)}
     return eval_statements(func[3], local_vars, function_table.copy())
 
 
@@ -612,6 +632,23 @@ def eval_expression(expression, variables, function_table):
     return left
 
 
+def eval_output(expression, variables, function_table):
+    """ Prints an expression, or queues it up if a parallel loop is running. """
+    if parallel_queue is None:
+        print(eval_expression(expression, variables, function_table))
+        return
+    snapshot = snapshot_variables(expression, variables)
+    if (any(isinstance(v, PendingCall) for v in snapshot.values())
+            or expression_variables(expression) & queued_variables):
+        # Needs the result of a call that hasn't run yet.
+        parallel_queue.append(lambda: print(eval_queued_expression(expression, snapshot,
+                                                                   variables,
+                                                                   function_table)))
+    else:
+        value = eval_expression(expression, variables, function_table)
+        parallel_queue.append(lambda: print(value))
+
+
 def eval_assignment(variable, expression, variables, function_table):
     # ...
     variables[variable[1]] = eval_expression(expression, variables, function_table)
@@ -629,15 +666,424 @@ def eval_statements(statements, variables={}, function_table={}):
             eval_statement(statement, variables, function_table)
 
 
-def run_program(ast):
-    """ Runs a rockstar program. """
+# PARALLEL EVAL BELLOW HERE.
+
+
+# Number of worker processes to run independent calls on, 0 runs everything
+# in this process.
+parallel_workers = 0
+# Number of calls to collect before they are sent off to the workers.
+PARALLEL_BATCH_SIZE = 256
+# Batches smaller than this are run in this process, handing them to the
+# workers costs more than it saves.
+PARALLEL_MIN_CALLS = 16
+# Calls, output and assignments, in program order, waiting for a batch
+# to finish.
+parallel_queue = None
+# Variables that are only set when the queue runs.
+queued_variables = set()
+# The worker processes, started on first use and kept for the whole program.
+parallel_pool = None
+# The functions the workers in the pool were started with.
+parallel_pool_functions = {}
+# The functions a worker process can call.
+worker_function_table = {}
+# The functions the purity and loop analysis was done for.
+analysed_functions = {}
+# If each function in analysed_functions is pure.
+pure_functions = {}
+# The result of find_independent_calls, by the id of the loop. The AST
+# outlives the program run, so the ids can't be reused.
+loop_analyses = {}
+
+
+class ParallelCallError(Exception):
+    """ Where a call that was run in parallel failed. """
+
+    def __init__(self, name, arguments, trace):
+        self.name = name
+        self.arguments = arguments
+        self.trace = trace
+
+    def __str__(self):
+        return "{} taking {} failed\n{}".format(self.name, self.arguments, self.trace)
+
+
+class PendingCall:
+    """ The result of a function call that is queued up to run in a
+        worker process. """
+
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = arguments
+        self.value = None
+        self.error = None
+        self.trace = None
+
+    def resolve(self):
+        """ Returns the result of the call, or raises what the call raised. """
+        if self.error is not None:
+            raise self.error from ParallelCallError(self.name, self.arguments, self.trace)
+        return self.value
+
+
+def resolve_pending(variables):
+    """ Returns a copy of the variables with all pending calls filled in. """
+    return {k: v.resolve() if isinstance(v, PendingCall) else v
+            for k, v in variables.items()}
+
+
+def snapshot_variables(expression, variables):
+    """ Copies the variables an expression reads, except the ones that are
+        only set when the queue runs. """
+    return {name: variables[name] for name in expression_variables(expression)
+            if name in variables and name not in queued_variables}
+
+
+def eval_queued_expression(expression, snapshot, variables, function_table):
+    """ Evaluates a queued expression with the variables as they were when
+        it was queued, and the queued variables as they are now. """
+    current = {name: variables[name] for name in queued_variables if name in variables}
+    current.update(resolve_pending(snapshot))
+    return eval_expression(expression, current, function_table)
+
+
+def queue_assignment(variable, expression, variables, function_table):
+    """ Queues up an assignment that needs the result of a pending call. """
+    snapshot = snapshot_variables(expression, variables)
+
+    def run():
+        variables[variable[1]] = eval_queued_expression(expression, snapshot,
+                                                        variables, function_table)
+    parallel_queue.append(run)
+
+
+def walk_statements(statements):
+    """ Yields all statements, including the ones in nested blocks. """
+    for statement in statements:
+        yield statement
+        if type_is(statement, TokenType.IF):
+            yield from walk_statements(statement[2])
+        elif type_is(statement, TokenType.LOOP):
+            yield from walk_statements(statement[3])
+
+
+def statement_expressions(statement):
+    """ Returns the expressions directly in a statement. """
+    if type_is(statement, TokenType.ASSIGNMENT):
+        return [statement[2]]
+    if type_is(statement, TokenType.LOOP):
+        return [statement[2]]
+    if statement[0] in (TokenType.OUTPUT, TokenType.IF, TokenType.RETURN):
+        return [statement[1]]
+    return []
+
+
+def expression_variables(expression):
+    """ Returns the names of all variables read by an expression. """
+    names = set()
+    for token in expression[1]:
+        if type_is(token, TokenType.VARIABLE):
+            names.add(token[1])
+        elif type_is(token, TokenType.CALL):
+            for argument in token[2]:
+                names |= expression_variables(argument)
+    return names
+
+
+def expression_calls(expression):
+    """ Returns the names of all functions called by an expression. """
+    names = set()
+    for token in expression[1]:
+        if type_is(token, TokenType.CALL):
+            names.add(token[1])
+            for argument in token[2]:
+                names |= expression_calls(argument)
+    return names
+
+
+def statement_reads(statement):
+    """ Returns the names of all variables read by a statement,
+        including nested blocks. """
+    names = set()
+    for inner in walk_statements([statement]):
+        if type_is(inner, TokenType.TURN):
+            names.add(inner[2][1])
+        for expression in statement_expressions(inner):
+            names |= expression_variables(expression)
+    return names
+
+
+def statement_writes(statement):
+    """ Returns the names of all variables set by a statement,
+        including nested blocks. """
+    names = set()
+    for inner in walk_statements([statement]):
+        if inner[0] in (TokenType.ASSIGNMENT, TokenType.INPUT):
+            names.add(inner[1][1])
+        elif type_is(inner, TokenType.TURN):
+            names.add(inner[2][1])
+    return names
+
+
+def is_call_assignment(statement):
+    """ Checks if a statement only assigns the result of a function call. """
+    if not type_is(statement, TokenType.ASSIGNMENT):
+        return False
+    _, _, (_, tokens) = statement
+    return len(tokens) == 1 and type_is(tokens[0], TokenType.CALL)
+
+
+def same_functions(known, function_table):
+    """ Checks if two function tables hold the same functions. """
+    return (len(known) == len(function_table)
+            and all(known.get(k) is v for k, v in function_table.items()))
+
+
+def find_pure_functions(function_table):
+    """ Finds which functions can't do any input or output, directly or
+        through the functions they call. """
+    pure = {}
+    callees = {}
+    for name, func in function_table.items():
+        pure[name] = True
+        callees[name] = set()
+        for statement in walk_statements(func[3]):
+            if statement[0] in (TokenType.OUTPUT, TokenType.INPUT, TokenType.FUNCTION):
+                pure[name] = False
+            for expression in statement_expressions(statement):
+                callees[name] |= expression_calls(expression)
+        if not callees[name] <= function_table.keys():
+            pure[name] = False
+    # Anything that can reach an impure function is impure.
+    changed = True
+    while changed:
+        changed = False
+        for name in pure:
+            if pure[name] and not all(pure[callee] for callee in callees[name]):
+                pure[name] = False
+                changed = True
+    return pure
+
+
+def refresh_analysis(function_table):
+    """ Throws away the purity and loop analysis if the functions changed
+        since it was done. """
+    global analysed_functions, pure_functions, loop_analyses
+    if not same_functions(analysed_functions, function_table):
+        analysed_functions = function_table.copy()
+        pure_functions = find_pure_functions(function_table)
+        loop_analyses = {}
+
+
+def is_pure_function(name, function_table):
+    """ Checks if a function can't do any input or output, directly or
+        through the functions it calls. """
+    refresh_analysis(function_table)
+    return pure_functions.get(name, False)
+
+
+def find_independent_calls(loop, function_table):
+    """ Finds the statements in a loop body that assign the result of a
+        pure function call to a variable the loop doesn't need to keep
+        going. Returns the indices of those statements, the indices of the
+        assignments that use the results and the variables those set, or
+        None if the loop has to run one call at a time. """
+    _, _, expr, body = loop
+    calls = expression_calls(expr)
+    for statement in walk_statements(body):
+        if statement[0] in (TokenType.INPUT, TokenType.FUNCTION, TokenType.RETURN):
+            return None
+        for expression in statement_expressions(statement):
+            calls |= expression_calls(expression)
+    if not all(is_pure_function(name, function_table) for name in calls):
+        return None
+
+    independent = set()
+    queued = set()
+    for i, statement in enumerate(body):
+        if not is_call_assignment(statement):
+            continue
+        # Everything that reads the result, directly or not, is queued up.
+        tainted = {statement[1][1]}
+        waiting = set()
+        changed = True
+        while changed:
+            changed = False
+            for j, other in enumerate(body):
+                if (j != i and j not in waiting and type_is(other, TokenType.ASSIGNMENT)
+                        and expression_variables(other[2]) & tainted):
+                    waiting.add(j)
+                    tainted.add(other[1][1])
+                    changed = True
+        # Output is queued up in order, so it may use the results.
+        reads = expression_variables(expr)
+        writes = set()
+        for j, other in enumerate(body):
+            if j not in waiting and not type_is(other, TokenType.OUTPUT):
+                reads |= statement_reads(other)
+                if j != i:
+                    writes |= statement_writes(other)
+        if tainted & reads:
+            continue
+        if {body[j][1][1] for j in waiting} & (writes | {statement[1][1]}):
+            continue
+        independent.add(i)
+        queued |= waiting
+    independent -= queued
+    if not independent:
+        return None
+    return independent, queued, {body[j][1][1] for j in queued}
+
+
+def loop_analysis(loop, function_table):
+    """ Returns find_independent_calls for a loop, it's only done again
+        if the functions change. """
+    refresh_analysis(function_table)
+    if id(loop) not in loop_analyses:
+        loop_analyses[id(loop)] = find_independent_calls(loop, function_table)
+    return loop_analyses[id(loop)]
+
+
+def init_parallel_worker(function_table):
+    """ Sets up a worker process with the functions it can call. """
+    global worker_function_table, parallel_workers, parallel_queue
+    worker_function_table = function_table
+    parallel_workers = 0
+    parallel_queue = None
+
+
+def try_call_function(name, arguments, function_table):
+    """ Runs a call, returning if it succeeded and the result, or the
+        error and where it happened. """
+    try:
+        return True, call_function(function_table[name], arguments, function_table)
+    except Exception as e:
+        return False, (e, traceback.format_exc())
+
+
+def run_parallel_call(job):
+    """ Runs a single call in a worker process. """
+    name, arguments = job
+    return try_call_function(name, arguments, worker_function_table)
+
+
+def get_parallel_pool(function_table):
+    """ Returns the worker pool, starting new workers only if they don't
+        know all the functions that can be called. """
+    global parallel_pool, parallel_pool_functions
+    if parallel_pool is not None and any(parallel_pool_functions.get(k) is not v
+                                         for k, v in function_table.items()):
+        parallel_pool.shutdown()
+        parallel_pool = None
+    if parallel_pool is None:
+        # The workers are forked, so they share this module and get the
+        # functions without them being sent over.
+        parallel_pool_functions = function_table.copy()
+        parallel_pool = ProcessPoolExecutor(max_workers=parallel_workers,
+                                            mp_context=multiprocessing.get_context("fork"),
+                                            initializer=init_parallel_worker,
+                                            initargs=(parallel_pool_functions,))
+    return parallel_pool
+
+
+def flush_parallel_batch(batch, function_table):
+    """ Runs all queued calls and then the rest of the queue, in program order. """
+    global parallel_queue
+    if batch:
+        jobs = [(pending.name, pending.arguments) for pending in batch]
+        if len(jobs) < PARALLEL_MIN_CALLS:
+            results = [try_call_function(name, arguments, function_table)
+                       for (name, arguments) in jobs]
+        else:
+            chunksize = max(1, len(jobs) // (4 * parallel_workers))
+            results = get_parallel_pool(function_table).map(run_parallel_call, jobs,
+                                                            chunksize=chunksize)
+        for pending, (ok, value) in zip(batch, results):
+            if ok:
+                pending.value = value
+            else:
+                pending.error, pending.trace = value
+        batch.clear()
+    events = parallel_queue
+    parallel_queue = []
+    for event in events:
+        event()
+
+
+def eval_parallel_loop(loop, analysis, variables, function_table):
+    """ Runs a loop where the independent calls are sent in batches to
+        worker processes. The output is the same as when run in order. """
+    global parallel_queue, queued_variables
+    _, comp, expr, body = loop
+    independent, queued, queued_variables = analysis
+    batch = []
+    parallel_queue = []
+    try:
+        while eval_expression(expr, variables, function_table) == comp:
+            for i, statement in enumerate(body):
+                if i in queued:
+                    queue_assignment(statement[1], statement[2], variables, function_table)
+                    continue
+                if i not in independent:
+                    eval_statement(statement, variables, function_table)
+                    continue
+                _, variable, (_, [call]) = statement
+                func = function_table[call[1]]
+                pending = PendingCall(call[1], eval_arguments(func, call, variables,
+                                                              function_table))
+                batch.append(pending)
+                parallel_queue.append(pending.resolve)
+                variables[variable[1]] = pending
+            if len(batch) >= PARALLEL_BATCH_SIZE:
+                flush_parallel_batch(batch, function_table)
+        flush_parallel_batch(batch, function_table)
+    except Exception:
+        # Everything that ran before the error still has to be shown.
+        flush_parallel_batch(batch, function_table)
+        raise
+    finally:
+        parallel_queue = None
+        queued_variables = set()
+    variables.update(resolve_pending(variables))
+
+
+def run_program(ast, workers=0):
+    """ Runs a rockstar program. Independent calls to pure functions in
+        loops are run on the given number of worker processes. This needs
+        the fork start method, everything runs in this process without it. """
+    global parallel_workers, parallel_pool
+    if workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        print("Parallel mode needs the fork start method, running sequentially",
+              file=sys.stderr)
+        workers = 0
+    parallel_workers = workers
     variables = {}
-    eval_statements(ast, variables)
+    try:
+        eval_statements(ast, variables)
+    finally:
+        if parallel_pool is not None:
+            parallel_pool.shutdown()
+            parallel_pool = None
     return variables
 
 if __name__ == "__main__":
     print("args: ", sys.argv)
-    filename = sys.argv[1]
+    args = sys.argv[1:]
+    workers = 0
+    for arg in [a for a in args if a == "--parallel" or a.startswith("--parallel=")]:
+        args.remove(arg)
+        _, _, count = arg.partition("=")
+        try:
+            workers = int(count) if count else os.cpu_count() or 1
+        except ValueError:
+            workers = 0
+        if workers < 1:
+            sys.exit("Expected a worker count of at least 1 for --parallel, got \"{}\"".format(count))
+    for arg in args:
+        if arg.startswith("--"):
+            sys.exit("Unknown option \"{}\"".format(arg))
+    filename = args[0]
     with open(filename) as source_file:
         ast, success = parse_source(source_file.read(), filename)
         if not success:
@@ -645,6 +1091,6 @@ if __name__ == "__main__":
         else:
             # print("\n".join(str(x) for x in ast))
             print("-------------------")
-            state = run_program(ast)
+            state = run_program(ast, workers)
             print("-------------------")
             print("state: ", state)
@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+""" Runs a rockstar program with and without --parallel and checks that
+    the output is the same. """
+import os
+import subprocess
+import sys
+
+
+def run(filename, flags):
+    """ Runs the interpreter, returning the exit code, the output and the
+        error it ended with. """
+    interpreter = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__main__.py")
+    result = subprocess.run([sys.executable, interpreter] + flags + [filename],
+                            capture_output=True, text=True)
+    # The first line echoes the arguments.
+    _, _, output = result.stdout.partition("\n")
+    error = result.stderr.strip()
+    if "Traceback (most recent call last)" in error:
+        # Where it failed differs between the runs, but not what failed.
+        error = error.split("\n")[-1]
+    return result.returncode, output, error
+
+
+if __name__ == "__main__":
+    filename = sys.argv[1] if len(sys.argv) > 1 else "parallel.rock"
+    workers = sys.argv[2] if len(sys.argv) > 2 else "4"
+    expected = run(filename, [])
+    actual = run(filename, ["--parallel=" + workers])
+    if expected != actual:
+        print("Output differs with --parallel={}".format(workers))
+        print("sequential: ", expected)
+        print("parallel: ", actual)
+        sys.exit(1)
+    print("Same output with and without --parallel={}".format(workers))